@@ -1,24 +1,75 @@
+import atexit
 import os
-from flask import Flask, render_template, request, redirect, url_for, flash, jsonify
+from flask import Flask, render_template, request, redirect, url_for, flash, jsonify, make_response, session
+from apscheduler.schedulers.background import BackgroundScheduler
+from flask.json.provider import DefaultJSONProvider
+from flask_caching import Cache
+from flask_compress import Compress
 from flask_login import LoginManager, login_user, logout_user, login_required, current_user
-from werkzeug.security import generate_password_hash, check_password_hash
+from werkzeug.security import check_password_hash
+from argon2 import PasswordHasher
+from argon2.exceptions import VerificationError, InvalidHashError
+from sqlalchemy import event, text
+from sqlalchemy.orm import joinedload, load_only
 from models import db, User, Patient, Medication, Prescription, PrescriptionItem, ClinicalNote
 from datetime import datetime
-import pandas as pd
-import plotly
-import plotly.express as px
-import json
+import hashlib
+import hmac
+import orjson
 from functools import wraps
 
+class ORJSONProvider(DefaultJSONProvider):
+    """JSON provider backed by orjson for jsonify and request.get_json"""
+    def dumps(self, obj, **kwargs):
+        # Callers passing options (e.g. the session serializer) need stdlib json
+        if kwargs:
+            return super().dumps(obj, **kwargs)
+        return orjson.dumps(obj, default=self.default).decode()
+
+    def loads(self, s, **kwargs):
+        # object_hook and friends are only supported by stdlib json
+        if kwargs:
+            return super().loads(s, **kwargs)
+        return orjson.loads(s)
+
+    def response(self, *args, **kwargs):
+        obj = self._prepare_response_obj(args, kwargs)
+        option = orjson.OPT_INDENT_2 if (self.compact is None and self._app.debug) or self.compact is False else 0
+        return self._app.response_class(
+            orjson.dumps(obj, default=self.default, option=option), mimetype=self.mimetype
+        )
+
 # Initialize Flask app
 app = Flask(__name__)
+app.json = ORJSONProvider(app)
 app.config['SECRET_KEY'] = 'your-secret-key-here'
 app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///data/pms.db'
 app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
+app.config['SQLALCHEMY_ENGINE_OPTIONS'] = {
+    'pool_size': 10,
+    'max_overflow': 20,
+    'pool_pre_ping': True,
+    'pool_recycle': 1800,
+    'connect_args': {'check_same_thread': False, 'timeout': 30}
+}
+
+# Number of rows shown per page in list views
+PER_PAGE = 50
 
 # Initialize database
 db.init_app(app)
 
+# Initialize response compression
+app.config['COMPRESS_ALGORITHM'] = ['br', 'gzip']
+app.config['COMPRESS_MIN_SIZE'] = 500
+Compress(app)
+
+# Initialize cache
+cache = Cache(app, config={'CACHE_TYPE': 'SimpleCache', 'CACHE_DEFAULT_TIMEOUT': 60})
+
+# Initialize password hasher
+password_hasher = PasswordHasher(time_cost=2, memory_cost=19456, parallelism=1)
+
 # Initialize login manager
 login_manager = LoginManager()
 login_manager.login_view = 'login'
@@ -26,11 +77,35 @@ login_manager.init_app(app)
 
 @login_manager.user_loader
 def load_user(user_id):
-    return User.query.get(int(user_id))
+    return db.session.get(User, int(user_id))
+
+def set_sqlite_pragmas(dbapi_connection, connection_record):
+    """Enable WAL mode and tune SQLite for concurrent readers"""
+    cursor = dbapi_connection.cursor()
+    cursor.execute("PRAGMA journal_mode=WAL")
+    cursor.execute("PRAGMA synchronous=NORMAL")
+    cursor.execute("PRAGMA cache_size=-20000")
+    cursor.execute("PRAGMA temp_store=MEMORY")
+    cursor.close()
 
 # Create database tables
 with app.app_context():
+    event.listen(db.engine, 'connect', set_sqlite_pragmas)
     db.create_all()
+    
+    # Databases created before is_low_stock existed need the column added
+    medication_columns = [row[1] for row in db.session.execute(text("PRAGMA table_xinfo(medication)"))]
+    if 'is_low_stock' not in medication_columns:
+        db.session.execute(text(
+            "ALTER TABLE medication ADD COLUMN is_low_stock BOOLEAN "
+            "GENERATED ALWAYS AS (quantity <= reorder_level) VIRTUAL"
+        ))
+    db.session.commit()
+    
+    # create_all() skips existing tables, so add any indexes they are missing
+    for table in db.metadata.sorted_tables:
+        for index in table.indexes:
+            index.create(db.engine, checkfirst=True)
 
 # Utility functions
 def create_backup():
@@ -42,6 +117,84 @@ def create_backup():
     # In a real app, you'd implement proper backup logic here
     return True
 
+# Run backups on a schedule instead of on the request path
+scheduler = BackgroundScheduler(daemon=True)
+scheduler.add_job(create_backup, 'interval', hours=1)
+
+def start_scheduler():
+    """Start the backup scheduler once per process and stop it at exit"""
+    if scheduler.running:
+        return
+    scheduler.start()
+    atexit.register(scheduler.shutdown)
+
+# Start backups in the process that serves requests (flask run, WSGI servers).
+# Under the debug reloader only the child serves; `python app.py` is handled
+# in __main__ below. Set PMS_BACKUP_SCHEDULER=0 to opt out, e.g. on all but one
+# gunicorn worker, and call start_scheduler() wherever backups should run.
+if (__name__ != '__main__' and os.environ.get('PMS_BACKUP_SCHEDULER') != '0'
+        and (not app.debug or os.environ.get('WERKZEUG_RUN_MAIN') == 'true')):
+    start_scheduler()
+
+def fig_to_json(fig):
+    """Serialize a Plotly figure to a JSON string using orjson"""
+    from plotly.utils import PlotlyJSONEncoder
+    
+    # Types orjson can't handle go through Plotly's encoder, which raises on unknown ones
+    return orjson.dumps(
+        fig.to_plotly_json(), option=orjson.OPT_SERIALIZE_NUMPY, default=PlotlyJSONEncoder().default
+    ).decode()
+
+@cache.memoize(60)
+def _dashboard_charts():
+    """Build dashboard charts and return them as serialized JSON strings"""
+    # Imported here so routes without charts don't pay plotly's import cost
+    import plotly.graph_objects as go
+    
+    # Patients by gender chart
+    gender_data = db.session.query(Patient.gender, db.func.count(Patient.id)).group_by(Patient.gender).all()
+    genders, gender_counts = zip(*gender_data) if gender_data else ([], [])
+    gender_fig = go.Figure(go.Pie(labels=genders, values=gender_counts))
+    gender_fig.update_layout(title='Patients by Gender')
+    gender_graph = fig_to_json(gender_fig)
+    
+    # Medications by dosage form chart
+    form_data = db.session.query(Medication.dosage_form, db.func.count(Medication.id)).group_by(Medication.dosage_form).all()
+    forms, form_counts = zip(*form_data) if form_data else ([], [])
+    form_fig = go.Figure(go.Bar(x=forms, y=form_counts))
+    form_fig.update_layout(title='Medications by Dosage Form', xaxis_title='Dosage Form', yaxis_title='Count')
+    form_graph = fig_to_json(form_fig)
+    
+    return gender_graph, form_graph
+
+def check_legacy_password_hash(pwhash, password):
+    """Check werkzeug hashes, including 'sha256$salt$hmac' ones werkzeug 3 rejects"""
+    if pwhash.startswith('sha256$'):
+        _, salt, expected = pwhash.split('$', 2)
+        actual = hmac.new(salt.encode(), password.encode(), 'sha256').hexdigest()
+        return hmac.compare_digest(actual, expected)
+    try:
+        return check_password_hash(pwhash, password)
+    except ValueError:
+        return False
+
+def verify_password(user, password):
+    """Check a password against the stored hash, upgrading legacy hashes to argon2"""
+    if not user.password.startswith('$argon2'):
+        if not check_legacy_password_hash(user.password, password):
+            return False
+        user.password = password_hasher.hash(password)
+        db.session.commit()
+        return True
+    try:
+        password_hasher.verify(user.password, password)
+    except (VerificationError, InvalidHashError):
+        return False
+    if password_hasher.check_needs_rehash(user.password):
+        user.password = password_hasher.hash(password)
+        db.session.commit()
+    return True
+
 def teacher_required(f):
     @wraps(f)
     def decorated_function(*args, **kwargs):
@@ -55,40 +208,46 @@ def teacher_required(f):
 @app.route('/')
 @login_required
 def dashboard():
-    # Create backup on each dashboard visit
-    create_backup()
-    
-    # Get statistics
+    # Get statistics in a single roundtrip
+    row = db.session.execute(text(
+        "SELECT "
+        "(SELECT COUNT(*) FROM patient), "
+        "(SELECT COUNT(*) FROM medication), "
+        "(SELECT COUNT(*) FROM prescription WHERE status = 'approved'), "
+        "(SELECT COUNT(*) FROM medication WHERE is_low_stock)"
+    )).one()
     stats = {
-        'patient_count': Patient.query.count(),
-        'medication_count': Medication.query.count(),
-        'active_prescriptions': Prescription.query.filter_by(status='approved').count(),
-        'low_stock': Medication.query.filter(Medication.quantity <= Medication.reorder_level).count()
+        'patient_count': row[0],
+        'medication_count': row[1],
+        'active_prescriptions': row[2],
+        'low_stock': row[3]
     }
     
     # Create charts with proper error handling
     try:
-        # Patients by gender chart
-        gender_data = db.session.query(Patient.gender, db.func.count(Patient.id)).group_by(Patient.gender).all()
-        gender_df = pd.DataFrame(gender_data, columns=['Gender', 'Count'])
-        gender_fig = px.pie(gender_df, values='Count', names='Gender', title='Patients by Gender')
-        gender_graph = json.dumps(gender_fig, cls=plotly.utils.PlotlyJSONEncoder)
-        
-        # Medications by dosage form chart
-        form_data = db.session.query(Medication.dosage_form, db.func.count(Medication.id)).group_by(Medication.dosage_form).all()
-        form_df = pd.DataFrame(form_data, columns=['Dosage Form', 'Count'])
-        form_fig = px.bar(form_df, x='Dosage Form', y='Count', title='Medications by Dosage Form')
-        form_graph = json.dumps(form_fig, cls=plotly.utils.PlotlyJSONEncoder)
-        
+        gender_graph, form_graph = _dashboard_charts()
     except Exception as e:
         print(f"Error generating charts: {str(e)}")
         gender_graph = "{}"
         form_graph = "{}"
     
-    return render_template('dashboard.html', 
-                         stats=stats,
-                         gender_graph=gender_graph,
-                         form_graph=form_graph)
+    # Let the browser reuse its copy when nothing on the page changed
+    etag = hashlib.md5(
+        orjson.dumps([current_user.id, stats]) + gender_graph.encode() + form_graph.encode()
+    ).hexdigest()
+    # Flask-Compress appends ':br'/':gzip' to the ETag it sends out
+    client_etags = {tag.rsplit(':', 1)[0] for tag in request.if_none_match.as_set(include_weak=True)}
+    if etag in client_etags and '_flashes' not in session:
+        response = make_response('', 304)
+    else:
+        response = make_response(render_template('dashboard.html', 
+                                                 stats=stats,
+                                                 gender_graph=gender_graph,
+                                                 form_graph=form_graph))
+    response.set_etag(etag)
+    response.cache_control.private = True
+    response.cache_control.no_cache = True
+    return response
 
 @app.route('/login', methods=['GET', 'POST'])
 def login():
@@ -98,7 +257,7 @@ def login():
         
         user = User.query.filter_by(username=username).first()
         
-        if not user or not check_password_hash(user.password, password):
+        if not user or not verify_password(user, password):
             flash('Invalid username or password', 'danger')
             return redirect(url_for('login'))
         
@@ -116,24 +275,38 @@ def logout():
 @app.route('/patients')
 @login_required
 def patients():
-    patient_list = Patient.query.order_by(Patient.last_name).all()
-    return render_template('patients.html', patients=patient_list)
+    page = request.args.get('page', 1, type=int)
+    pagination = Patient.query.options(
+        load_only(Patient.patient_id, Patient.first_name, Patient.last_name,
+                  Patient.dob, Patient.gender, Patient.blood_type)
+    ).order_by(Patient.last_name).paginate(page=page, per_page=PER_PAGE, error_out=False)
+    return render_template('patients.html', patients=pagination.items, pagination=pagination)
 
 @app.route('/medications')
 @login_required
 def medications():
-    med_list = Medication.query.order_by(Medication.name).all()
-    low_stock = Medication.query.filter(Medication.quantity <= Medication.reorder_level).all()
-    return render_template('medications.html', medications=med_list, low_stock=low_stock)
+    page = request.args.get('page', 1, type=int)
+    pagination = Medication.query.options(
+        load_only(Medication.name, Medication.generic_name, Medication.dosage_form,
+                  Medication.strength, Medication.quantity, Medication.reorder_level)
+    ).order_by(Medication.name).paginate(page=page, per_page=PER_PAGE, error_out=False)
+    low_stock = Medication.query.options(
+        load_only(Medication.name, Medication.strength, Medication.quantity, Medication.reorder_level)
+    ).filter_by(is_low_stock=True).all()
+    return render_template('medications.html', medications=pagination.items, low_stock=low_stock, pagination=pagination)
 
 @app.route('/prescriptions')
 @login_required
 def prescriptions():
-    if current_user.role == 'teacher':
-        prescription_list = Prescription.query.order_by(Prescription.date_prescribed.desc()).all()
-    else:
-        prescription_list = Prescription.query.filter_by(prescriber_id=current_user.id).order_by(Prescription.date_prescribed.desc()).all()
-    return render_template('prescriptions.html', prescriptions=prescription_list)
+    query = Prescription.query.options(
+        joinedload(Prescription.patient),
+        joinedload(Prescription.items).joinedload(PrescriptionItem.medication)
+    )
+    if current_user.role != 'teacher':
+        query = query.filter_by(prescriber_id=current_user.id)
+    page = request.args.get('page', 1, type=int)
+    pagination = query.order_by(Prescription.date_prescribed.desc()).paginate(page=page, per_page=PER_PAGE, error_out=False)
+    return render_template('prescriptions.html', prescriptions=pagination.items, pagination=pagination)
 
 @app.route('/calculators')
 @login_required
@@ -170,6 +343,40 @@ def calculate_bmi():
             'message': str(e)
         })
 
+@app.route('/calculate/bmi_batch', methods=['POST'])
+@login_required
+def calculate_bmi_batch():
+    import numpy as np
+    
+    data = request.get_json()
+    try:
+        weights = np.asarray(data['weights'], dtype=np.float64)
+        heights = np.asarray(data['heights'], dtype=np.float64) / 100
+        if weights.ndim != 1 or weights.shape != heights.shape:
+            raise ValueError('weights and heights must be lists of the same length')
+        if not (np.all(np.isfinite(weights)) and np.all(np.isfinite(heights))):
+            raise ValueError('weights and heights must be finite numbers')
+        if np.any(weights <= 0) or np.any(heights <= 0):
+            raise ValueError('weights and heights must be positive')
+        bmi = weights / (heights * heights)
+        
+        categories = np.select(
+            [bmi < 18.5, bmi < 25, bmi < 30],
+            ['Underweight', 'Normal weight', 'Overweight'],
+            'Obese'
+        )
+        
+        return jsonify({
+            'results': np.round(bmi, 2).tolist(),
+            'categories': categories.tolist(),
+            'status': 'success'
+        })
+    except Exception as e:
+        return jsonify({
+            'status': 'error',
+            'message': str(e)
+        })
+
 @app.route('/calculate/creatinine_clearance', methods=['POST'])
 @login_required
 def calculate_ccr():
@@ -217,6 +424,7 @@ def add_patient():
             
             db.session.add(patient)
             db.session.commit()
+            cache.delete_memoized(_dashboard_charts)
             flash('Patient added successfully', 'success')
             return redirect(url_for('patients'))
         except Exception as e:
@@ -229,7 +437,9 @@ def add_patient():
 @login_required
 def view_patient(id):
     patient = Patient.query.get_or_404(id)
-    prescriptions = Prescription.query.filter_by(patient_id=id).order_by(Prescription.date_prescribed.desc()).all()
+    prescriptions = Prescription.query.options(
+        joinedload(Prescription.items).joinedload(PrescriptionItem.medication)
+    ).filter_by(patient_id=id).order_by(Prescription.date_prescribed.desc()).all()
     clinical_notes = ClinicalNote.query.filter_by(patient_id=id).order_by(ClinicalNote.date.desc()).all()
     return render_template('view_patient.html', patient=patient, prescriptions=prescriptions, clinical_notes=clinical_notes)
 
@@ -255,6 +465,7 @@ def add_medication():
             
             db.session.add(medication)
             db.session.commit()
+            cache.delete_memoized(_dashboard_charts)
             flash('Medication added successfully', 'success')
             return redirect(url_for('medications'))
         except Exception as e:
@@ -278,7 +489,7 @@ def create_prescription():
             )
             
             db.session.add(prescription)
-            db.session.commit()
+            db.session.flush()
             
             # Add prescription items
             medication_ids = request.form.getlist('medication_id[]')
@@ -286,15 +497,18 @@ def create_prescription():
             frequencies = request.form.getlist('frequency[]')
             durations = request.form.getlist('duration[]')
             
-            for med_id, dosage, frequency, duration in zip(medication_ids, dosages, frequencies, durations):
-                item = PrescriptionItem(
-                    prescription_id=prescription.id,
-                    medication_id=int(med_id),
-                    dosage=dosage,
-                    frequency=frequency,
-                    duration=duration
-                )
-                db.session.add(item)
+            items = [
+                {
+                    'prescription_id': prescription.id,
+                    'medication_id': int(med_id),
+                    'dosage': dosage,
+                    'frequency': frequency,
+                    'duration': duration
+                }
+                for med_id, dosage, frequency, duration in zip(medication_ids, dosages, frequencies, durations)
+            ]
+            if items:
+                db.session.execute(db.insert(PrescriptionItem), items)
             
             db.session.commit()
             flash('Prescription created successfully', 'success')
@@ -303,8 +517,12 @@ def create_prescription():
             db.session.rollback()
             flash(f'Error creating prescription: {str(e)}', 'danger')
     
-    patients = Patient.query.order_by(Patient.last_name).all()
-    medications = Medication.query.order_by(Medication.name).all()
+    patients = Patient.query.options(
+        load_only(Patient.patient_id, Patient.first_name, Patient.last_name)
+    ).order_by(Patient.last_name).all()
+    medications = Medication.query.options(
+        load_only(Medication.name, Medication.strength)
+    ).order_by(Medication.name).all()
     return render_template('create_prescription.html', patients=patients, medications=medications)
 
 @app.route('/prescription/approve/<int:id>')
@@ -343,7 +561,11 @@ def add_clinical_note(patient_id):
 @app.route('/prescription/<int:id>')
 @login_required
 def view_prescription(id):
-    prescription = Prescription.query.get_or_404(id)
+    prescription = Prescription.query.options(
+        joinedload(Prescription.patient),
+        joinedload(Prescription.prescriber),
+        joinedload(Prescription.items).joinedload(PrescriptionItem.medication)
+    ).filter_by(id=id).first_or_404()
     return render_template('view_prescription.html', prescription=prescription)
 
 # Initialize first user if none exists
@@ -352,7 +574,7 @@ def initialize_first_user():
         if not User.query.first():
             admin = User(
                 username='admin',
-                password=generate_password_hash('admin123', method='sha256'),
+                password=password_hasher.hash('admin123'),
                 role='teacher'
             )
             db.session.add(admin)
@@ -360,4 +582,7 @@ def initialize_first_user():
 
 if __name__ == '__main__':
     initialize_first_user()
+    # The reloader runs this module twice; only the serving child runs jobs
+    if os.environ.get('PMS_BACKUP_SCHEDULER') != '0' and os.environ.get('WERKZEUG_RUN_MAIN') == 'true':
+        start_scheduler()
     app.run(debug=True)
@@ -7,8 +7,10 @@ db = SQLAlchemy()
 class User(UserMixin, db.Model):
     id = db.Column(db.Integer, primary_key=True)
     username = db.Column(db.String(50), unique=True, nullable=False)
-    password = db.Column(db.String(100), nullable=False)
+    password = db.Column(db.String(255), nullable=False)
     role = db.Column(db.String(20), default='student')  # 'student' or 'teacher'
+    prescriptions = db.relationship('Prescription', back_populates='prescriber')
+    clinical_notes = db.relationship('ClinicalNote', back_populates='author')
 
 class Patient(db.Model):
     id = db.Column(db.Integer, primary_key=True)
@@ -22,6 +24,11 @@ class Patient(db.Model):
     medical_history = db.Column(db.Text)
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
     updated_at = db.Column(db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
+    prescriptions = db.relationship('Prescription', back_populates='patient')
+    clinical_notes = db.relationship('ClinicalNote', back_populates='patient')
+    __table_args__ = (
+        db.Index('ix_patient_lastname', 'last_name'),
+    )
 
 class Medication(db.Model):
     id = db.Column(db.Integer, primary_key=True)
@@ -32,9 +39,14 @@ class Medication(db.Model):
     manufacturer = db.Column(db.String(100))
     quantity = db.Column(db.Integer, default=0)
     reorder_level = db.Column(db.Integer, default=10)
+    is_low_stock = db.Column(db.Boolean, db.Computed('quantity <= reorder_level'), index=True)
     indications = db.Column(db.Text)
     contraindications = db.Column(db.Text)
     side_effects = db.Column(db.Text)
+    prescription_items = db.relationship('PrescriptionItem', back_populates='medication')
+    __table_args__ = (
+        db.Index('ix_med_name', 'name'),
+    )
 
 class Prescription(db.Model):
     id = db.Column(db.Integer, primary_key=True)
@@ -43,8 +55,14 @@ class Prescription(db.Model):
     date_prescribed = db.Column(db.DateTime, default=datetime.utcnow)
     status = db.Column(db.String(20), default='pending')  # pending, approved, denied, dispensed
     instructions = db.Column(db.Text)
-    patient = db.relationship('Patient', backref='prescriptions')
-    prescriber = db.relationship('User', backref='prescriptions')
+    patient = db.relationship('Patient', back_populates='prescriptions')
+    prescriber = db.relationship('User', back_populates='prescriptions')
+    items = db.relationship('PrescriptionItem', back_populates='prescription')
+    __table_args__ = (
+        db.Index('ix_presc_status_date', 'status', 'date_prescribed'),
+        db.Index('ix_presc_prescriber_date', 'prescriber_id', 'date_prescribed'),
+        db.Index('ix_presc_patient_date', 'patient_id', 'date_prescribed'),
+    )
 
 class PrescriptionItem(db.Model):
     id = db.Column(db.Integer, primary_key=True)
@@ -53,8 +71,8 @@ class PrescriptionItem(db.Model):
     dosage = db.Column(db.String(100), nullable=False)
     frequency = db.Column(db.String(100), nullable=False)
     duration = db.Column(db.String(50))  # e.g., "7 days", "1 month"
-    medication = db.relationship('Medication', backref='prescription_items')
-    prescription = db.relationship('Prescription', backref='items')
+    medication = db.relationship('Medication', back_populates='prescription_items')
+    prescription = db.relationship('Prescription', back_populates='items')
 
 class ClinicalNote(db.Model):
     id = db.Column(db.Integer, primary_key=True)
@@ -63,5 +81,5 @@ class ClinicalNote(db.Model):
     date = db.Column(db.DateTime, default=datetime.utcnow)
     note_type = db.Column(db.String(50))  # progress, assessment, plan, etc.
     content = db.Column(db.Text, nullable=False)
-    patient = db.relationship('Patient', backref='clinical_notes')
-    author = db.relationship('User', backref='clinical_notes')
+    patient = db.relationship('Patient', back_populates='clinical_notes')
+    author = db.relationship('User', back_populates='clinical_notes')